@@ -6,8 +6,8 @@ svc_list = []
 hostname = {}
 
 services = zeroconf.search(domain="local")
-if len(services) is 0:
-    print "No device found"
+if len(services) == 0:
+    print("No device found")
     sys.exit(0)
 
 for host in services.items():
@@ -33,4 +33,4 @@ for key, value in hostname.items():
     svc_list.append(value)
 
 out_data = json.dumps(svc_list, indent=True)
-print out_data
+print(out_data)
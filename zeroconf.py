@@ -5,17 +5,23 @@
 Simple/Pythonic Zeroconf Service Search/Registration
 """
 
-__author__ = u"Sébastien Boisgérault <Sebastien.Boisgerault@mines-paristech.fr>"
+__author__ = "Sébastien Boisgérault <Sebastien.Boisgerault@mines-paristech.fr>"
 __license__ = "MIT License"
 __url__ = "https://github.com/boisgera/zeroconf" 
 __version__ = "2.0.1"
 
-# Python 2.7 Standard Library
+# Python 3 Standard Library
 import atexit
-import pipes
-import re
+import collections
+import collections.abc
+import functools
+import os
+import queue
+import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
 
 if sys.platform.startswith("linux"):
@@ -26,26 +32,47 @@ if sys.platform.startswith("linux"):
 elif sys.platform.startswith("win"):
     startupinfo = subprocess.STARTUPINFO()
     startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-    try:
-        process = subprocess.Popen("dns-sd", startupinfo=startupinfo)
-        process.kill()
-    except WindowsError:
+    if shutil.which("dns-sd") is None:
         raise ImportError("unable to find dns-sd command-line tools")
 
 # Service Search
 # ------------------------------------------------------------------------------
+class _Service(collections.abc.Mapping):
+    """
+    Service data, as a read-only mapping or as attributes
+
+    Compares equal to the dictionary with the same items.
+    """
+    __slots__ = ("hostname", "address", "port", "txt")
+
+    def __init__(self, hostname, address, port, txt):
+        self.hostname = hostname
+        self.address = address
+        self.port = port
+        self.txt = txt
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        return repr(dict(self))
+
 def search(name=None, type=None, domain="local"):
     """
     Search available Zeroconf services
 
     The result is a dictionary with service (name, type, domain) keys 
-    and data values ; data are dictionaries with "hostname", "address", 
-    "port" and "txt" keys.
+    and data values ; data are mappings with "hostname", "address", 
+    "port" and "txt" keys, that are also available as attributes.
     """
-    def name_match(service):
-        name_, _, _ = service
-        return (name is None or name_ == name)
-
     if sys.platform.startswith("linux"):
 
         options = {"terminate"   : True  ,
@@ -53,72 +80,160 @@ def search(name=None, type=None, domain="local"):
                    "parsable"    : True  ,
                    "no-db-lookup": True  ,
                    "domain"      : domain}
+        # the browser may be killed early: exit codes are only checked
+        # when the iteration is over, not in sh's background thread
         if type:
-             results = sh.avahi_browse(type, **options)
+             results = sh.avahi_browse(type, _iter=True, _bg_exc=False, 
+                                       **options)
         else:
-             results = sh.avahi_browse(all=True, **options)
-        results = [line.split(";") for line in results.splitlines()]
+             results = sh.avahi_browse(all=True, _iter=True, _bg_exc=False, 
+                                       **options)
 
         info = {}
-        for result in results:
-            if result[0] == "=":
-                symbol, _, ip_version, name_, type_, domain_, \
-                hostname, address, port, txt = result
-                name_ = decode(name_)
-                if ip_version == "IPv4":
-                    info[(name_, type_, domain_)] = {"hostname": hostname,
-                                                     "address" : address ,
-                                                     "port"    : port    ,
-                                                     "txt"     : txt     }
-
-
+        for line in results:
+            if not line.startswith("="):
+                continue
+            result = line.rstrip("\n").split(";", 9)
+            if len(result) != 10 or result[2] != "IPv4":
+                continue
+            symbol, _, ip_version, name_, type_, domain_, \
+            hostname, address, port, txt = result
+            name_ = decode(name_)
+            info[(name_, type_, domain_)] = (hostname, address, port, txt)
+            if type and name_ == name:
+                results.kill() # fully specified service found
+                break
 
     elif sys.platform.startswith("win"):
 
         if not type:
             type = "_http._tcp"
 
-        process = subprocess.Popen("dns-sd -Z " + type + " " + domain, \
+        args = ["dns-sd", "-Z", type, domain]
+        process = subprocess.Popen(args, \
                                    stdout=subprocess.PIPE, \
+                                   universal_newlines=True, \
                                    startupinfo=startupinfo) 
-        time.sleep(1.0)
-        process.kill()
-        results = process.stdout.read()
-        results =  [line.split() for line in results.splitlines()]
+        results = _read_lines(process, _follow(process), 
+                              time.monotonic() + 1.0, idle=0.25)
+        results =  [line.split() for line in results]
+
+        hostnames = set(result[5] for result in results 
+                        if len(result) == 14 and result[1] == "SRV")
+        addresses = get_addresses(hostnames)
 
         info = {}
         name_ = port = hostname = address = ""
 
         for result in results:
             if len(result) == 14 and result[1] == "SRV":
-                name_ = decode(result[0]).split(".")[0]
+                name_, _, type_ = decode(result[0]).partition(".")
                 port = result[4]
                 hostname = result[5]
-                address = get_address(hostname)
-                type_ = decode(result[0])[(decode(result[0]).find(".") + 1):]
+                address = addresses[hostname]
 
             if len(result) == 3 and result[1] == "TXT":
                 txt = str.replace(result[2],'"','')
-                info[(name_, type_, domain)] = {"hostname": hostname,
-                                               "address" : address ,
-                                               "port"    : port    ,
-                                               "txt"     : txt     }
+                info[(name_, type_, domain)] = (hostname, address, port, txt)
+                if name_ == name:
+                    break # fully specified service found
+
+    # data tuples are wrapped for the selected services only
+    return {key: _Service(*data) for key, data in info.items() 
+            if name is None or key[0] == name}
 
-    filtered_info = [item for item in info.items() if name_match(item[0])]
-    return dict(filtered_info)
+# resolved addresses and resolution times by hostname, least recently used first
+_address_cache = collections.OrderedDict()
+_address_cache_size = 256
+_address_ttl = 1.0  # seconds
 
 def get_address(hostname):
-    process = subprocess.Popen("dns-sd -Q " + hostname,
-                         stdout=subprocess.PIPE, startupinfo=startupinfo)
-    time.sleep(0.1)
-    process.kill()
-    results = process.stdout.read()
-    results =  [line.split() for line in results.splitlines()]
+    return get_addresses([hostname])[hostname]
+
+def get_addresses(hostnames):
+    """
+    Resolve several hostnames concurrently
+
+    The result is a dictionary with hostname keys and address values ;
+    the address is an empty string when the hostname could not be resolved.
+    Successful resolutions are reused for `_address_ttl` seconds ; at most
+    `_address_cache_size` of them are kept.
+    """
+    now = time.monotonic()
+    addresses = {}
+    processes = {}
+    for hostname in hostnames:
+        cached = _address_cache.get(hostname)
+        if cached is not None:
+            if now - cached[1] < _address_ttl:
+                _address_cache.move_to_end(hostname)
+                addresses[hostname] = cached[0]
+                continue
+            del _address_cache[hostname]
+        process = subprocess.Popen(["dns-sd", "-Q", hostname],
+                             stdout=subprocess.PIPE, universal_newlines=True,
+                             startupinfo=startupinfo)
+        processes[hostname] = (process, _follow(process))
+    deadline = time.monotonic() + 0.1
+
+    for hostname, (process, pending) in processes.items():
+        results = _read_lines(process, pending, deadline, count=2)
+        results =  [line.split() for line in results]
+        if len(results) >= 2:
+            addresses[hostname] = results[1][len(results[1]) - 1]
+            _address_cache[hostname] = (addresses[hostname], time.monotonic())
+            _address_cache.move_to_end(hostname)
+            if len(_address_cache) > _address_cache_size:
+                _address_cache.popitem(last=False)
+        else:
+            addresses[hostname] = ''
+    return addresses
+
+def _follow(process):
+    """
+    Queue the lines of the standard output of a process as they arrive
+
+    Pipes cannot be polled with `select` on Windows, so the lines are 
+    collected by a helper thread ; `None` is queued when the output ends.
+    """
+    pending = queue.Queue()
+    def reader():
+        for line in iter(process.stdout.readline, ""):
+            pending.put(line)
+        pending.put(None)
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    return pending
+
+def _read_lines(process, pending, deadline, idle=None, count=None):
+    """
+    Get the lines queued by `_follow(process)`, then kill the process
 
-    if len(results) >= 1:
-        return results[1][len(results[1]) - 1]
-    return ''
+    Reading stops when the process output ends, at the `deadline` time,
+    after `count` lines or when no new line has been received for `idle` 
+    seconds, whichever comes first.
+    Lines that are already queued are always collected.
+    """
+    lines = []
+    while count is None or len(lines) < count:
+        wait = deadline - time.monotonic()
+        if idle is not None and lines:
+            wait = min(wait, idle)
+        try:
+            if wait > 0:
+                line = pending.get(timeout=wait)
+            else:
+                line = pending.get_nowait()
+        except queue.Empty:
+            break
+        if line is None:
+            break
+        lines.append(line)
+    process.kill()
+    return [line.rstrip("\r\n") for line in lines]
 
+@functools.lru_cache(maxsize=1024)
 def decode(text):
     r"""
 Decode string with special characters escape sequences.
@@ -142,27 +257,45 @@ Characters may go beyond the 0-127 (ascii) range:
 for example, the 'RIGHT SINGLE QUOTATION MARK', 
 encoded in utf-8 by the three bytes 226, 128 and 153 (decimal):
 
-    >>> decode(r"\226\128\153")
-    '\xe2\x80\x99'
+    >>> decode(r"\226\128\153") == "’"
+    True
 
-Input strings in unicode are ok as long as they belong to the ascii range:
+Input byte strings are ok as long as they belong to the ascii range:
 
-    >>> decode(ur"\226\128\153")
-    '\xe2\x80\x99'
+    >>> decode(rb"\226\128\153") == "’"
+    True
 """
+    if isinstance(text, bytes):
+        text = text.decode("ascii")
+    i = text.find("\\")
+    if i < 0:
+        return text
+
+    # escape sequences stand for utf-8 bytes: rewrite them in the ascii 
+    # encoded text and copy the unescaped runs in bulk in between
     text = text.encode("ascii")
-    def replace(match):
-        numeric, other = match.groups()
-        if numeric:
-            return chr(int(numeric[1:]))
+    chunks = []
+    start = 0
+    while i >= 0 and i + 1 < len(text):
+        chunks.append(text[start:i])
+        digits = text[i+1:i+4]
+        if len(digits) == 3 and digits.isdigit():
+            chunks.append(bytes([int(digits)]))
+            start = i + 4
         else:
-            return other[1:]
-
-    return re.sub(r"(\\\d\d\d)|(\\.)", replace, text)
+            chunks.append(text[i+1:i+2])
+            start = i + 2
+        i = text.find(b"\\", start)
+    chunks.append(text[start:])
+    return b"".join(chunks).decode("utf-8", "replace")
 
 # Service Registration
 # ------------------------------------------------------------------------------
 _publishers = {} # service publisher processes identified by (name, type, port)
+_by_name = collections.defaultdict(set) # (name, type, port) keys by name
+_by_type = collections.defaultdict(set) # (name, type, port) keys by type
+_by_port = collections.defaultdict(set) # (name, type, port) keys by port
+_indices = (_by_name, _by_type, _by_port)
 
 def register(name, type, port):
     """
@@ -174,16 +307,30 @@ def register(name, type, port):
     else:
         if sys.platform.startswith("linux"):
             args = ["avahi-publish", "-s", name, type, port]
-            publisher = subprocess.Popen(args, stderr=subprocess.PIPE, \
-                                               stdout=subprocess.PIPE)
-            _publishers[(name, type, port)] = publisher
+            publisher = subprocess.Popen(args, stderr=subprocess.DEVNULL, \
+                                               stdout=subprocess.DEVNULL, \
+                                               start_new_session=True)
+            _add_publisher((name, type, port), publisher)
             
         elif sys.platform.startswith("win"): 
-            args = 'dns-sd -R "' + name + '" ' + type + " local " + port
-            publisher = subprocess.Popen(args, stderr=subprocess.PIPE, \
-                                               stdout=subprocess.PIPE, \
+            args = ["dns-sd", "-R", name, type, "local", port]
+            publisher = subprocess.Popen(args, stderr=subprocess.DEVNULL, \
+                                               stdout=subprocess.DEVNULL, \
                                                startupinfo=startupinfo)                   
-            _publishers[(name, type, port)] = publisher
+            _add_publisher((name, type, port), publisher)
+
+def _add_publisher(key, publisher):
+    _publishers[key] = publisher
+    for index, value in zip(_indices, key):
+        index[value].add(key)
+
+def _remove_publisher(key):
+    publisher = _publishers.pop(key)
+    for index, value in zip(_indices, key):
+        index[value].discard(key)
+        if not index[value]:
+            del index[value]
+    return publisher
 
 def unregister(name=None, type=None, port=None):
     """
@@ -197,15 +344,40 @@ def unregister(name=None, type=None, port=None):
     """
     if port:
         port = str(port)
-    pids = []
-    for name_, type_, port_ in _publishers:
-        if (name is None or name_ == name) and \
-           (type is None or type_ == type) and \
-           (port is None or port_ == port):
-           pids.append((name_, type_, port_))
-    for pid in pids:
-        _publishers[pid].kill()
-        del _publishers[pid]
+    if name is not None and type is not None and port is not None:
+        if (name, type, port) in _publishers:
+            _stop([_remove_publisher((name, type, port))])
+        return
+    selectors = [index.get(value, set()) 
+                 for index, value in zip(_indices, (name, type, port))
+                 if value is not None]
+    if selectors:
+        selectors.sort(key=len)
+        keys = selectors[0].intersection(*selectors[1:])
+    else:
+        keys = set(_publishers)
+    _stop([_remove_publisher(key) for key in keys])
+
+def _stop(publishers):
+    """
+    Terminate publisher processes, then wait for all of them to exit
+
+    On Linux, each publisher leads its own session, so its whole process 
+    group is terminated.
+    """
+    for publisher in publishers:
+        if publisher.poll() is not None:
+            continue
+        if sys.platform.startswith("linux"):
+            os.killpg(publisher.pid, signal.SIGTERM)
+        else:
+            publisher.kill()
+    for publisher in publishers:
+        try:
+            publisher.wait(timeout=0.1)
+        except subprocess.TimeoutExpired:
+            publisher.kill()
+            publisher.wait()
 
 atexit.register(unregister)
 
@@ -220,12 +392,19 @@ def test_basic():
     >>> register(name="my web server", type="_http._tcp", port="49152")
     >>> time.sleep(1.0)
     
-    Basic search (fully specified):
-    >>> services = search("my web server", "_http._tcp", "local")
+    Basic search (fully specified), that stops the service browser as soon
+    as the service is found, without any error report:
+    >>> import contextlib, io
+    >>> errors = io.StringIO()
+    >>> with contextlib.redirect_stderr(errors):
+    ...     services = search("my web server", "_http._tcp", "local")
+    ...     time.sleep(2.0)
+    >>> errors.getvalue()
+    ''
     >>> info = services.get(("my web server", "_http._tcp", "local"))
     >>> info is not None
     True
-    >>> print info["port"]
+    >>> print(info["port"])
     49152
 
     The `domain` argument is optional and defaults to "local":
@@ -238,7 +417,7 @@ def test_basic():
 
     The service `name` is optional too:
     >>> http_services = search(type="_http._tcp")
-    >>> services.items()[0] in http_services.items()
+    >>> list(services.items())[0] in http_services.items()
     True
 
     Unregister the HTTP server: